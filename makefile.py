@@ -23,279 +23,453 @@
 #
 
 
+import io
 import os
+import pickle
+import hashlib
 import re
 import sys
-import pathlib
 import argparse
-from enum import Enum
+import multiprocessing
 from textwrap import dedent
+from itertools import chain
 from collections import defaultdict
 from os.path import join as pathjoin
 
 
+# The generated Makefile is accumulated here and written
+# to stdout in one go once generation has finished.
+output = io.StringIO()
+
+# Fixed fragments of the generated rules, joined with the
+# per-file parts in emit().  The build tree prefix (the build
+# root with a trailing "/", prepended to source-relative paths)
+# and the include flags depend on the command line, so they
+# are set once the arguments are parsed.  All build tree paths
+# are derived from out_prefix.
+CC_COMPILE = "\t$(CC) $(CFLAGS) "
+CXX_COMPILE = "\t$(CXX) $(CXXFLAGS) $(PB_INCLUDES) "
+COMPILE_OUTPUT = " -c $< -o $@\n\n"
+CXX_LINK = "\t$(CXX) $(CXXFLAGS) -o $@ $^ $(PB_LIBS) "
+LINK_OUTPUT = " -pthread\n\n"
+include_flags = ""
+out_prefix = ""
+
+
 file_types = {}
-def handles(extension, produces=None):
+def handles(extension, produces=None, aliases=None):
     """ Class decorator that registers a class
         as handling a specific file extension. """
     def deco(cls):
         file_types[extension] = cls
         setattr(cls, "extension", extension)
         setattr(cls, "produces", produces or [])
+        setattr(cls, "aliases", aliases or [])
         return cls
     return deco
 
 
-# These regex helpers remain at global scope so that the
-# compiled regex caching is done once per process.
-def has_main(contents, regex=re.compile(r'^\s*int\s+main\s*\((int[^\)]*|\s*)\)', re.MULTILINE)):
-    return regex.search(contents) != None
-def get_includes(contents, regex=re.compile(r'^\s*#include\s*"([^"]+)"\s*$', re.MULTILINE)):
-    return regex.findall(contents)
-def get_imports(contents, regex=re.compile(r'^\s*import\s*"([^"]+)"\s*;\s*$', re.MULTILINE)):
-    return regex.findall(contents)
-def get_compileargs(contents, regex=re.compile(r'^\s*//\s*@compileargs\s+(.*)\s*$', re.MULTILINE)):
-    return regex.findall(contents)
-def get_linkargs(contents, regex=re.compile(r'^\s*//\s*@linkargs\s+(.*)\s*$', re.MULTILINE)):
-    return regex.findall(contents)
+class Source:
+    """ Struct returned by parse_source() describing the
+        directives found in a source file. """
+    def __init__(self):
+        self.includes = []
+        self.imports = []
+        self.compileargs = []
+        self.linkargs = []
+        self.has_main = False
+
+
+# The directive regex remains at global scope so that the
+# compiled regex caching is done once per process.  All of the
+# directive forms are alternatives of a single pattern so that
+# each file's contents are only scanned once.  Contents are
+# matched as raw bytes; only the captured text is decoded.
+# Files that contain none of the directive keywords at all
+# are ruled out by a cheap literal search first.
+def parse_source(contents,
+                 keywords=re.compile(rb'#include|import|@compileargs|@linkargs|main'),
+                 regex=re.compile(rb'''
+        ^\s*(?:
+            \#include\s*"(?P<includes>[^"]+)"\s*$
+          | import\s*"(?P<imports>[^"]+)"\s*;\s*$
+          | //\s*@compileargs[ \t]+(?P<compileargs>.*)\s*$
+          | //\s*@linkargs[ \t]+(?P<linkargs>.*)\s*$
+          | (?P<has_main>)(?=int\s+main\s*\((?:int[^\)]*|\s*)\))
+        )''', re.MULTILINE | re.VERBOSE)):
+    source = Source()
+    if not keywords.search(contents):
+        return source
+    for match in regex.finditer(contents):
+        kind = match.lastgroup
+        if kind == "has_main":
+            source.has_main = True
+        else:
+            getattr(source, kind).append(match.group(kind).decode("utf-8", "surrogateescape"))
+    return source
+
+
+def parse_file(filename):
+    """ Read and parse a single source file.  This runs in
+        worker processes, so it only deals in plain data. """
+    with open(filename, "rb") as f:
+        return parse_source(f.read())
 
 
 
 class Emitted:
-    """ Struct returned by emit() describing emitted artifacts. """
+    """ Struct returned by emit() describing emitted artifacts.
+        Patterns are (class, dirname) keys, rendered once per
+        key through the class's render_pattern(). """
     def __init__(self, directories=None, executables=None, patterns=None):
         self.directories = directories
         self.executables = executables
         self.patterns = patterns
 
-class FileAction(Enum):
-    INCOMPATIBLE = 1
-    REPLACE = 2
-    DROP = 3
-
 
 class File:
 
-    def __init__(self, filename, contents):
+    # Trees can hold many thousands of files, so keep instances
+    # compact.  The extension is a class attribute set by @handles.
+    __slots__ = ("fullpath", "filename", "dirname", "base",
+                 "dependencies", "includes", "compileargs", "linkargs",
+                 "_swapped", "_aliases", "_rec_deps", "_linkargs",
+                 "_out_compile_alias", "_out_artifacts")
+
+    # When a plain header and another file claim the same alias
+    # (e.g. foo.h and foo.cc both answer to "foo.h"), the file
+    # with the higher priority takes it.  Any other collision,
+    # such as a checked-in foo.pb.cc against foo.proto's
+    # generated foo.pb.h, is a conflict.
+    priority = 0
+
+    def __init__(self, filename, source):
         self.fullpath = filename
         assert filename.startswith(src_dir)
         self.filename = filename[len(src_dir):]
         self.dirname = os.path.dirname(self.filename)
-        (self.base, self.extension) = os.path.splitext(self.filename)
+        (self.base, _) = os.path.splitext(self.filename)
+        self._swapped = {}
+        self._aliases = (self.filename,) + tuple(self.swap_extension(e) for e in self.aliases)
         self.dependencies = []
         self.includes = []
         self.compileargs = []
         self.linkargs = []
-        self.initialize(contents)
+        self._rec_deps = None
+        self._out_compile_alias = None
+        self._out_artifacts = None
+        self._linkargs = None
+        self.initialize(source)
 
-    def initialize(self, contents):
+    def initialize(self, source):
         assert False, "Not implemented in base class"
 
     def swap_extension(self, new_extension):
-        return self.base + new_extension
+        swapped = self._swapped.get(new_extension)
+        if swapped is None:
+            swapped = self._swapped[new_extension] = self.base + new_extension
+        return swapped
 
-    def get_variants(self, extensions, prepend_dir=""):
-        return [pathjoin(prepend_dir, self.swap_extension(e)) for e in extensions]
+    def get_variants(self, extensions, prefix=""):
+        return [prefix + self.swap_extension(e) for e in extensions]
 
     def get_aliases(self):
-        return [self.filename]
+        return self._aliases
 
     def artifacts(self):
         return self.get_variants(self.produces)
 
-    def emit(self, out_dir):
+    def set_out_prefix(self, prefix):
+        """ Cache the build tree paths that dependents of
+            this file refer to in their own stanzas. """
+        self._out_compile_alias = prefix + self.get_aliases()[-1]
+        self._out_artifacts = self.get_variants(self.produces, prefix)
+
+    def emit(self):
         return Emitted()  # By default emit nothing.
 
-    def has_relation(self, file):
-        return FileAction.INCOMPATIBLE
-
-    def __recursive_deps(self, deps=None, seen=None):
-        # TODO: memoize?
-        if not seen:
-            seen = set()
-        if not deps:
-            deps = []
-        for dep in self.dependencies:
-            if not dep.filename in seen:
+    def walk_dependencies(self):
+        """ Walk the dependency graph from this file, returning
+            every transitive dependency in pre-order. """
+        deps = []
+        seen = set()
+        stack = list(reversed(self.dependencies))
+        while stack:
+            dep = stack.pop()
+            if dep.filename not in seen:
                 seen.add(dep.filename)
                 deps.append(dep)
-                dep.__recursive_deps(deps, seen)
+                stack.extend(reversed(dep.dependencies))
         return deps
 
-    def __apply_rec(self, getter):
-        ret = []
-        for dep in self.__recursive_deps():
-            ret += getter(dep)
-        return ret
-
     def get_compile_dependencies(self):
-        return self.__apply_rec(lambda dep: dep.get_aliases()[-1:])
+        deps = [dep._out_compile_alias for dep in self._rec_deps]
+        assert len(deps) == len(set(deps)), f"cd: {deps}"
+        return deps
 
     def get_link_dependencies(self):
-        return self.__apply_rec(lambda dep: dep.artifacts())
+        deps = list(chain.from_iterable(dep._out_artifacts for dep in self._rec_deps))
+        assert len(deps) == len(set(deps)), f"ld: {deps}"
+        return deps
 
     def get_linkargs(self):
-        return set(self.__apply_rec(lambda dep: dep.linkargs))
+        return self._linkargs
 
     def __str__(self):
         return f"{self.filename}"
 
 
-@handles(extension=".cc", produces=[".o"])
+@handles(extension=".cc", produces=[".o"], aliases=[".h"])
 class CCFile(File):
 
-    def initialize(self, contents):
-        self.includes = get_includes(contents)
-        self.compileargs = get_compileargs(contents)
-        self.linkargs = get_linkargs(contents)
-        self.__is_link_target = has_main(contents)
+    __slots__ = ("__is_link_target",)
+    priority = 3
 
-    def get_aliases(self):
-        return [self.filename, self.swap_extension(".h")]
+    def initialize(self, source):
+        self.includes = source.includes
+        self.compileargs = source.compileargs
+        self.linkargs = source.linkargs
+        self.__is_link_target = source.has_main
 
-    def has_relation(self, file):
-        if self.swap_extension(".h") == file.filename:
-            return FileAction.DROP
-        return FileAction.INCOMPATIBLE
-
-    def emit(self, out_dir):
-        obj_file = pathjoin(out_dir, self.swap_extension(".o"))
-        includes = " ".join([pathjoin(out_dir, f) for f in self.get_compile_dependencies()])
+    def emit(self):
+        obj_file = out_prefix + self.swap_extension(".o")
+        includes = " ".join(self.get_compile_dependencies())
         compileargs = " ".join(self.compileargs)
-        print(f"{obj_file}: {self.fullpath} {includes}")
-        print(f"\t$(CXX) $(CXXFLAGS) $(PB_INCLUDES) {compileargs} -I{src_dir} -I{out_dir} -c $< -o $@")
-        print()
+        output.write("".join([obj_file, ": ", self.fullpath, " ", includes, "\n",
+                              CXX_COMPILE, compileargs, " ", include_flags, COMPILE_OUTPUT]))
         emitted = Emitted(directories=[os.path.dirname(obj_file)])
         if self.__is_link_target:
-            executable = pathjoin(out_dir, self.swap_extension(""))
-            deps = " ".join([pathjoin(out_dir, x) for x in self.get_link_dependencies()])
+            executable = out_prefix + self.base
+            deps = " ".join(self.get_link_dependencies())
             linkargs = " ".join(list(self.get_linkargs()) + self.linkargs)
-            print(f"{executable}: {deps} {obj_file}")
-            print(f"\t$(CXX) $(CXXFLAGS) -o $@ $^ $(PB_LIBS) {linkargs} -pthread")
-            print()
+            output.write("".join([executable, ": ", deps, " ", obj_file, "\n",
+                                  CXX_LINK, linkargs, LINK_OUTPUT]))
             emitted.executables = [executable]
         return emitted
 
-@handles(extension=".c", produces=[".o"])
+@handles(extension=".c", produces=[".o"], aliases=[".h"])
 class CFile(File):
 
-    def initialize(self, contents):
-        self.includes = get_includes(contents)
-        self.compileargs = get_compileargs(contents)
-        self.linkargs = get_linkargs(contents)
+    __slots__ = ()
+    priority = 3
 
-    def get_aliases(self):
-        return [self.filename, self.swap_extension(".h")]
+    def initialize(self, source):
+        self.includes = source.includes
+        self.compileargs = source.compileargs
+        self.linkargs = source.linkargs
 
-    def has_relation(self, file):
-        if self.swap_extension(".h") == file.filename:
-            return FileAction.DROP
-        return FileAction.INCOMPATIBLE
-
-    def emit(self, out_dir):
-        obj_file = pathjoin(out_dir, self.swap_extension(".o"))
-        includes = " ".join([pathjoin(out_dir, f) for f in self.get_compile_dependencies()])
+    def emit(self):
+        obj_file = out_prefix + self.swap_extension(".o")
+        includes = " ".join(self.get_compile_dependencies())
         compileargs = " ".join(self.compileargs)
-        print(f"{obj_file}: {self.fullpath} {includes}")
-        print(f"\t$(CC) $(CFLAGS) -I{src_dir} -I{out_dir} {compileargs} -c $< -o $@")
-        print()
+        output.write("".join([obj_file, ": ", self.fullpath, " ", includes, "\n",
+                              CC_COMPILE, include_flags, " ", compileargs, COMPILE_OUTPUT]))
         return Emitted(directories=[os.path.dirname(obj_file)])
 
 @handles(extension=".h")
 class HeaderFile(File):
 
-    def initialize(self, contents):
-        self.includes = filter(lambda s: s not in self.get_aliases(), get_includes(contents))
+    __slots__ = ()
+    priority = 1
 
-    def has_relation(self, file):
-        if self.base == file.base and file.extension in [CCFile.extension, CFile.extension]:
-            return FileAction.REPLACE
-        return FileAction.INCOMPATIBLE
+    def initialize(self, source):
+        aliases = set(self.get_aliases())
+        self.includes = [s for s in source.includes if s not in aliases]
 
-    def emit(self, out_dir):
-        build_dir = pathjoin(out_dir, self.dirname)
+    @staticmethod
+    def render_pattern(dirname):
+        build_dir = out_prefix + dirname
         dst = pathjoin(build_dir, "%.h")
-        src = pathjoin(src_dir, self.dirname, "%.h")
-
-        pattern = f"{dst}: {src}\n" \
-                  f"\tcp $< $@\n"
+        src = pathjoin(src_dir, dirname, "%.h")
+        return f"{dst}: {src}\n" \
+               f"\tcp $< $@\n"
 
-        return Emitted(directories=[build_dir], patterns=[pattern])
+    def emit(self):
+        build_dir = out_prefix + self.dirname
+        return Emitted(directories=[build_dir], patterns=[(HeaderFile, self.dirname)])
 
 
-@handles(extension=".cch", produces=[".cch.o"])
+@handles(extension=".cch", produces=[".cch.o"], aliases=[".cch.h"])
 class CCHFile(File):
 
-    def initialize(self, contents):
-        self.includes = filter(lambda s: not s in self.get_aliases(), get_includes(contents))
-        self.compileargs = get_compileargs(contents)
-        self.linkargs = get_linkargs(contents)
-
-    def get_aliases(self):
-        return [self.filename, self.filename + ".h"]
+    __slots__ = ()
+    priority = 3
 
-    def emit(self, out_dir):
-        (cc_file, obj_file) = self.get_variants([".cch.cc", ".cch.o"],
-                                                prepend_dir=out_dir)
-        includes = " ".join([pathjoin(out_dir, f) for f in self.get_compile_dependencies()])
-        compileargs = " ".join(self.compileargs)
+    def initialize(self, source):
+        aliases = set(self.get_aliases())
+        self.includes = [s for s in source.includes if s not in aliases]
+        self.compileargs = source.compileargs
+        self.linkargs = source.linkargs
 
-        build_dir = pathjoin(out_dir, self.dirname)
+    @staticmethod
+    def render_pattern(dirname):
+        build_dir = out_prefix + dirname
         output_base = pathjoin(build_dir, "%.cch")
-        src_pattern = pathjoin(src_dir, self.dirname, "%.cch")
-        include_path = pathjoin(self.dirname, "%f")
+        src_pattern = pathjoin(src_dir, dirname, "%.cch")
+        include_path = pathjoin(dirname, "%f")
+        return f"{output_base}.cc {output_base}.h: {src_pattern}\n" \
+               f"\t$(CCH) --input $< --include={include_path} --output={build_dir}/%f\n"
 
-        pattern = f"{output_base}.cc {output_base}.h: {src_pattern}\n" \
-                  f"\t$(CCH) --input $< --include={include_path} --output={build_dir}/%f\n"
+    def emit(self):
+        (cc_file, obj_file) = self.get_variants([".cch.cc", ".cch.o"],
+                                                prefix=out_prefix)
+        includes = " ".join(self.get_compile_dependencies())
+        compileargs = " ".join(self.compileargs)
+        build_dir = out_prefix + self.dirname
 
-        print(f"{obj_file}: {cc_file} {includes}")
-        print(f"\t$(CXX) $(CXXFLAGS) $(PB_INCLUDES) -I{src_dir} -I{out_dir} {compileargs} -c $< -o $@")
-        print()
-        return Emitted(directories=[build_dir], patterns=[pattern])
+        output.write("".join([obj_file, ": ", cc_file, " ", includes, "\n",
+                              CXX_COMPILE, include_flags, " ", compileargs, COMPILE_OUTPUT]))
+        return Emitted(directories=[build_dir], patterns=[(CCHFile, self.dirname)])
 
 
-@handles(extension=".proto", produces=[".grpc.pb.o", ".pb.o"])
+@handles(extension=".proto", produces=[".grpc.pb.o", ".pb.o"],
+         aliases=[".pb.h", ".grpc.pb.h"])
 class ProtobufFile(File):
 
-    def initialize(self, contents):
-        self.includes = get_imports(contents)
+    __slots__ = ()
+    priority = 2
 
-    def get_aliases(self):
-        return [self.filename, self.swap_extension(".pb.h"), self.swap_extension(".grpc.pb.h")]
+    def initialize(self, source):
+        self.includes = source.imports
 
-    def emit(self, out_dir):
+    @staticmethod
+    def render_pattern(dirname):
+        build_dir = out_prefix + dirname
+        src = pathjoin(src_dir, dirname, "%.proto")
+        variants = " ".join([pathjoin(build_dir, x) for x in ["%.grpc.pb.cc", "%.grpc.pb.h", "%.pb.cc", "%.pb.h"]])
+        return f"{variants}: {src}\n" \
+               f"\t$(PROTOC) --grpc_out={out_prefix} --cpp_out={out_prefix} -I{src_dir} $<\n"
+
+    def emit(self):
         (grpc_cc, grpc_o) = self.get_variants([".grpc.pb.cc", ".grpc.pb.o"],
-                                              prepend_dir=out_dir)
+                                              prefix=out_prefix)
         (pb_cc, pb_o) = self.get_variants([".pb.cc", ".pb.o"],
-                                          prepend_dir=out_dir)
-
-        build_dir = pathjoin(out_dir, self.dirname)
-        src = pathjoin(src_dir, self.dirname, "%.proto")
-        variants = " ".join([pathjoin(build_dir, x) for x in ["%.grpc.pb.cc", "%.grpc.pb.h", "%.pb.cc", "%.pb.h"]])
-        pattern = f"{variants}: {src}\n" \
-                  f"\t$(PROTOC) --grpc_out={out_dir} --cpp_out={out_dir} -I{src_dir} $<\n"
+                                          prefix=out_prefix)
+        build_dir = out_prefix + self.dirname
 
-        deps = " ".join([pathjoin(out_dir, x) for x in self.get_compile_dependencies()])
+        deps = " ".join(self.get_compile_dependencies())
         for (cc_file, obj_file) in [(pb_cc, pb_o), (grpc_cc, grpc_o)]:
-            print(f"{obj_file}: {cc_file} {deps}")
-            print(f"\t$(CXX) $(CXXFLAGS) $(PB_INCLUDES) -I{out_dir} -c $< -o $@")
-        print()
-        return Emitted(directories=[build_dir], patterns=[pattern])
+            output.write("".join([obj_file, ": ", cc_file, " ", deps, "\n",
+                                  CXX_COMPILE, "-I", out_prefix, " -c $< -o $@\n"]))
+        output.write("\n")
+        return Emitted(directories=[build_dir], patterns=[(ProtobufFile, self.dirname)])
+
+
+def resolve_transitive_dependencies(files):
+    """ Compute the transitive dependencies of every file in a
+        single post-order pass over the dependency graph, building
+        each file's list from the already computed lists of its
+        direct dependencies.  Files that include an include cycle
+        fall back to walking the graph directly, since a cycle's
+        lists do not compose. """
+    ACTIVE, DONE = 1, 2
+    state = {}
+    cyclic = set()
+    for root in files:
+        if root in state:
+            continue
+        state[root] = ACTIVE
+        stack = [(root, iter(root.dependencies))]
+        while stack:
+            (file, children) = stack[-1]
+            for child in children:
+                if child not in state:
+                    state[child] = ACTIVE
+                    stack.append((child, iter(child.dependencies)))
+                    break
+            else:
+                stack.pop()
+                if any(state[dep] == ACTIVE or dep in cyclic for dep in file.dependencies):
+                    deps = file.walk_dependencies()
+                    if file in deps:
+                        cyclic.add(file)
+                else:
+                    deps = []
+                    seen = set()
+                    for dep in file.dependencies:
+                        for d in chain((dep,), dep._rec_deps):
+                            if d.filename not in seen:
+                                seen.add(d.filename)
+                                deps.append(d)
+                file._rec_deps = deps
+                file._linkargs = set(chain.from_iterable(dep.linkargs for dep in deps))
+                state[file] = DONE
 
 
 def find_files(root_dir, extensions):
     """ Return all files under a subdirectory
         that match the extensions filter. """
-    for (dirname, subdirs, files) in os.walk(root_dir, topdown=False):
-        # Yield each file that matches the extensions list.
-        for filename in files:
-            (_, extension) = os.path.splitext(filename)
-            if extension in extensions:
-                yield pathjoin(dirname, filename)
-        # Recurse into each subdirectory.
-        for subdir in subdirs:
-            find_files(pathjoin(root_dir, subdir), extensions)
-
+    extensions = tuple(extensions)
+    pending = [root_dir]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(extensions):
+                    yield entry.path
+
+
+def leaf_directories(directories):
+    """ Return the directories that are not a parent of another
+        directory in the list, in sorted order.  Creating
+        just these creates the whole directory structure. """
+    dirs = sorted({os.path.normpath(d) for d in directories}, key=lambda d: d.split("/"))
+    return [d for (d, after) in zip(dirs, dirs[1:] + [None])
+            if after is None or not after.startswith(d + "/")]
+
+
+def stat_files(filenames):
+    """ Return the (mtime, size) of each file, keyed by filename. """
+    stats = {}
+    for filename in filenames:
+        st = os.stat(filename)
+        stats[filename] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def tree_stamp(stats, *inputs):
+    """ Hash the path, mtime and size of every file, along with
+        any other inputs that affect the generated Makefile. """
+    h = hashlib.blake2b(digest_size=16)
+    for value in inputs:
+        h.update(repr(value).encode("utf-8", "surrogateescape") + b"\0")
+    for (filename, (mtime, size)) in sorted(stats.items()):
+        h.update(f"{filename}\0{mtime}\0{size}\n".encode("utf-8", "surrogateescape"))
+    return h.hexdigest()
+
+
+def read_stamp(path):
+    """ Return the (stamp, build directories, Makefile) saved
+        by a previous run, or (None, [], None) if there is none. """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return (None, [], None)
+
+
+def read_sources(path, version):
+    """ Return the {filename: ((mtime, size), Source)} map saved by
+        a previous run, or an empty map if there is no usable one. """
+    try:
+        with open(path, "rb") as f:
+            (saved_version, sources) = pickle.load(f)
+    except Exception:
+        return {}
+    return sources if saved_version == version else {}
+
+
+def write_sources(path, version, sources):
+    """ Save the parsed sources for read_sources() to pick up. """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump((version, sources), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
 
 
 if __name__ == "__main__":
@@ -307,16 +481,19 @@ if __name__ == "__main__":
     parser.add_argument("--cstd", default="c11", help="C version")
     parser.add_argument("--optimization", default="2", help="Optimization level (-OX)")
     parser.add_argument("--debug", action="store_true", help="Debug logging to stderr")
+    parser.add_argument("--no-cache", action="store_true", help="Always regenerate, ignoring any cached output")
     args = parser.parse_args()
 
-    # Set the two global variables.
+    # Set the global variables.
     globals()["debug"] = lambda s: print(f">> {s}", file=sys.stderr) if args.debug else None
     src_dir = args.src_root
+    out_prefix = args.build_root.rstrip("/") + "/"
+    include_flags = f"-I{src_dir} -I{out_prefix}"
 
     # Print the normal Makefile pre-amble - setting of tool names, flags, etc.
     # The default target is 'all', which is a list of all linkable executables.
     # Also provides a 'clean' target which removes the build directory.
-    print(dedent(f"""\
+    output.write(dedent(f"""\
     CC ?= gcc
     CXX ?= g++
     CCH ?= cch
@@ -334,6 +511,7 @@ if __name__ == "__main__":
     .PHONY: clean
     clean:
     \trm -rf {args.build_root}
+
     """))
 
     files = []
@@ -341,55 +519,99 @@ if __name__ == "__main__":
 
     # Enumerate the set of files in the source root that
     # we are interested in putting into the Makefile.
-    for filename in find_files(src_dir, file_types.keys()):
-        with open(filename, "r") as f:
-            contents = f.read()
-
+    filenames = list(find_files(src_dir, file_types.keys()))
+
+    # If no source file has been added, removed or touched since
+    # the last run (and neither the arguments nor this script have
+    # changed), the previously generated Makefile is still correct.
+    stats = stat_files(filenames)
+    this_script = os.stat(__file__)
+    script_version = (this_script.st_mtime_ns, this_script.st_size)
+    stamp_path = pathjoin(args.build_root, ".mkpy.stamp")
+    options = sorted((k, v) for (k, v) in vars(args).items() if k not in ("debug", "no_cache"))
+    stamp = tree_stamp(stats, options, script_version)
+    (cached_stamp, cached_directories, cached_output) = read_stamp(stamp_path)
+    if not args.no_cache and cached_stamp == stamp:
+        debug("Source tree unchanged, reusing cached Makefile")
+        sys.stdout.write(cached_output)
+        # The build tree may have been partially removed since.
+        for build_dir in cached_directories:
+            os.makedirs(build_dir, exist_ok=True)
+        sys.exit(0)
+
+    # Files whose mtime and size match the previous run are not
+    # read again; their parsed directives are reused from disk.
+    sources_path = pathjoin(args.build_root, ".mkpy_meta.pkl")
+    cached_sources = {} if args.no_cache else read_sources(sources_path, script_version)
+    sources = {}
+    stale = []
+    for filename in filenames:
+        cached = cached_sources.get(filename)
+        if cached and cached[0] == stats[filename]:
+            sources[filename] = cached[1]
+        else:
+            stale.append(filename)
+    debug(f"Parsing {len(stale)} of {len(filenames)} files")
+
+    # Parsing is CPU bound regex work and independent per file, so
+    # it is spread over worker processes (small batches aren't worth
+    # the pool startup cost).  The File objects and the file map
+    # are built on this process in enumeration order to keep the
+    # result deterministic.
+    if len(stale) < 256:
+        parsed = list(map(parse_file, stale))
+    else:
+        with multiprocessing.Pool() as pool:
+            parsed = pool.map(parse_file, stale, chunksize=32)
+    sources.update(zip(stale, parsed))
+    if stale or len(cached_sources) != len(sources):
+        write_sources(sources_path, script_version,
+                      {filename: (stats[filename], sources[filename]) for filename in filenames})
+
+    for filename in filenames:
         (_, extension) = os.path.splitext(filename)
-        file_class = file_types.get(extension)
-        file = file_class(filename, contents)
+        file = file_types[extension](filename, sources[filename])
         files.append(file)
 
         for alias in file.get_aliases():
             in_map = file_map.get(alias, None)
-            if in_map:
-                action = in_map.has_relation(file)
-                if action == FileAction.INCOMPATIBLE:
-                    raise Exception(f"{alias} ({type(in_map).__name__}) already exists"
-                                    f"in file map as {in_map} ({type(in_map).__name__})")
-                elif action == FileAction.DROP:
-                    continue
-                # Otherwise the action is REPLACE, so drop through and replace it.
-
-            file_map[alias] = file
-
-    # Resolve the dependency tree.
+            if in_map is None:
+                file_map[alias] = file
+            elif isinstance(in_map, HeaderFile) and file.priority > in_map.priority:
+                file_map[alias] = file
+            elif not (isinstance(file, HeaderFile) and in_map.priority > file.priority):
+                raise Exception(f"{alias} ({type(file).__name__}) already exists "
+                                f"in file map as {in_map} ({type(in_map).__name__})")
+
+    # Resolve the dependency tree.  All includes are checked
+    # up front so that every unknown file is reported at once.
+    missing = {include for file in files for include in file.includes} - file_map.keys()
+    if missing:
+        raise Exception("\n".join(f"{file.filename} references unknown file {include}"
+                                   for file in files
+                                   for include in file.includes if include in missing))
     for file in files:
-        for include in file.includes:
-            if include not in file_map:
-                raise Exception(f"{file.filename} references unknown file {include}")
-            include = file_map[include]
-            # Don't add a file as a dependency of itself.
-            if include is not file:
-                file.dependencies.append(include)
+        deps = [file_map[include] for include in file.includes]
+        # Don't add a file as a dependency of itself.
+        file.dependencies = [dep for dep in deps if dep is not file]
+
+    resolve_transitive_dependencies(files)
 
 
     executables = []
     build_directories = set()
-    patterns = set()
+    patterns = {}
     dir_targets = defaultdict(list)
 
+    for file in files:
+        file.set_out_prefix(out_prefix)
+
     # Loop over the files and emit their Makefile stanzas.
     # This is done separately because the first time a file
     # is encountered in the initial loop above, it is unlikely
     # to have a full picture of its recursive dependencies.
     for file in files:
-        cd = file.get_compile_dependencies()
-        ld = file.get_link_dependencies()
-        assert len(cd) == len(set(cd)), f"cd: {cd}"
-        assert len(ld) == len(set(ld)), f"ld: {ld}"
-
-        emitted = file.emit(args.build_root)
+        emitted = file.emit()
         assert isinstance(emitted, Emitted), \
             "emit() must return an Emitted object"
         if emitted.executables:
@@ -399,35 +621,51 @@ if __name__ == "__main__":
         if emitted.directories:
             build_directories.update(emitted.directories)
         if emitted.patterns:
-            patterns.update(emitted.patterns)
+            for key in emitted.patterns:
+                if key not in patterns:
+                    (file_class, dirname) = key
+                    patterns[key] = file_class.render_pattern(dirname)
 
-    for pattern in patterns:
-        print(pattern)
+    for pattern in patterns.values():
+        output.write(f"{pattern}\n")
 
     # Print a list of convenience directory build targets
     # that depend on all of the executables in that directory.
     for (dir, products) in dir_targets.items():
-        print(f"{dir} {dir}/: {' '.join(products)}")
-        print()
+        output.write(f"{dir} {dir}/: {' '.join(products)}\n\n")
 
     # Print the Makefile post-amble.  Include all of the
     # executable targets in the default Makefile target.
     # Output a target to make the directory structure in
     # the build directory.
-    #build_directories = " \\\n    \t".join(build_directories)
+    build_directories = leaf_directories(build_directories)
+    mkdir_args = " \\\n    \t".join(build_directories)
     executables = " \\\n    \t".join(executables)
-    print(dedent(f"""\
+    output.write(dedent(f"""\
     .PHONY: builddirs
     builddirs:
-    \t@mkdir -p
+    \t@mkdir -p {mkdir_args}
 
     .PHONY: all
     all: \
     \t{executables}
-    """));
+
+    """))
+    sys.stdout.write(output.getvalue())
 
     # Make sure the directory structure in the build directory
     # is in place.  This helps tools/compilers that won't build
     # directory structure on their own.
+    # Only the leaves need creating, their parents come with them.
     for build_dir in build_directories:
-        pathlib.Path(build_dir).mkdir(parents=True, exist_ok=True)
+        os.makedirs(build_dir, exist_ok=True)
+
+    # Save the generated Makefile so that the next run
+    # can skip regeneration if nothing has changed.
+    os.makedirs(args.build_root, exist_ok=True)
+    # Written aside and renamed into place, so that an interrupted
+    # write can never leave a valid stamp with a truncated Makefile.
+    with open(stamp_path + ".tmp", "wb") as f:
+        pickle.dump((stamp, build_directories, output.getvalue()), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(stamp_path + ".tmp", stamp_path)